@@ -1,15 +1,38 @@
-from fastapi import FastAPI, HTTPException
-from PIL import Image
+from fastapi import FastAPI, HTTPException, Response
+from PIL import Image, ImageDraw, ImageFont
 import uvicorn
+import asyncio
 import base64
 import io
 import json
+import os
+
+# Persist Inductor's compiled kernels next to the models so restarts skip recompilation (read at torch import)
+os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", "/app/models/inductor-cache")
+# Model switches free and reallocate GBs of weights; expandable segments keep that space reusable
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512")
+
+import numpy as np
 import torch
 import logging
 from pydantic import BaseModel
 from typing import Dict, Any, List
-import os
-import glob
+import hashlib
+import time
+
+try:
+    import orjson  # Optional: several times faster than stdlib json for the response envelope
+except ImportError:
+    orjson = None
+
+try:
+    import pybase64  # Optional: SIMD base64, several times faster than the stdlib encoder
+except ImportError:
+    pybase64 = None
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -20,76 +43,221 @@ app = FastAPI()
 # Global variables
 pipeline = None
 current_model = None
+lcm_enabled = False
+downloaded_models = set()  # (hub repo or checkpoint path, variant) pairs already in the local cache - skip revalidation on reload
 available_models = {}
+result_cache = OrderedDict()  # (model, prompt, ..., seed, format) -> (encoded image, sampler/model info), LRU order
+embeds_cache = OrderedDict()  # (model, prompt, negative_prompt) -> text encoder output, LRU order
+vram_status = None  # Last check_vram_availability() result
+vram_checked_at = 0.0
+
+# Single worker: the pipeline isn't thread-safe and torch already uses every core per op
+sd_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sd-pipeline")
+
+# Micro-batching: concurrent txt2img requests with matching shapes share one pipeline call
+batch_queue = None
+batch_task = None
+pipeline_lock = None  # Held while a batch runs or the model is being swapped
+
+# A1111-style names for the schedulers this server uses
+SAMPLER_NAMES = {
+    "DPMSolverMultistepScheduler": "DPM++ 2M Karras",
+    "EulerDiscreteScheduler": "Euler",
+    "EulerAncestralDiscreteScheduler": "Euler a",
+    "PNDMScheduler": "PLMS",
+    "DDIMScheduler": "DDIM",
+    "LCMScheduler": "LCM",
+}
+
+# Runtime tuning (override via environment)
+SD_MODEL_ID = os.environ.get("SD_MODEL_ID", "runwayml/stable-diffusion-v1-5")  # e.g. stabilityai/sd-turbo
+LCM_LORA = os.environ.get("SD_LCM_LORA", "0") == "1"  # 1 = load LCM-LoRA for 4-8 step SD 1.5
+MAX_BATCH = max(1, int(os.environ.get("SD_MAX_BATCH", "4")))
+BATCH_WINDOW = float(os.environ.get("SD_BATCH_WINDOW_MS", "20")) / 1000
+RESULT_CACHE_SIZE = 64
+EMBEDS_CACHE_SIZE = 128
+COMPILE_MODEL = os.environ.get("SD_COMPILE_MODEL", "0") == "1"
+COMPILE_MODE = os.environ.get("SD_COMPILE_MODE", "reduce-overhead")  # default / reduce-overhead / max-autotune
+AOT_UNET = os.environ.get("SD_AOT_UNET", "0") == "1"  # 1 = ahead-of-time compiled U-Net, cached on disk
+AOT_CACHE_DIR = os.environ.get("SD_AOT_CACHE_DIR", "/app/models/aot")
+WARMUP = os.environ.get("SD_WARMUP", "1") == "1"  # 0 = skip the startup warm-up generation
+BASE_CHECKPOINT = os.environ.get("SD_BASE_CHECKPOINT", "/app/models/sd15-base.safetensors")  # Used instead of the hub repo when present
+HF_OFFLINE = os.environ.get("HF_HUB_OFFLINE", "0") == "1"  # Never revalidate cached hub files
+VRAM_CHECK_INTERVAL = 5.0  # Seconds a VRAM reading is reused on the request path
+
+DEFAULT_MODEL = SD_MODEL_ID.rstrip("/").split("/")[-1]
+DEFAULT_MODEL_TYPE = "sd_turbo" if "turbo" in SD_MODEL_ID.lower() else "sd15"
+
+# One generator per batch slot, re-seeded per request instead of allocating new ones
+generators = [torch.Generator() for _ in range(MAX_BATCH)]
+
+def reset_generators(device):
+    """Recreate the generator pool on the execution device (GPU under offload hooks) so noise is drawn where it's used"""
+    global generators
+    generators = [torch.Generator(device=device) for _ in range(MAX_BATCH)]
 
 class ImageRequest(BaseModel):
     prompt: str
     negative_prompt: str = ""
     width: int = 512
     height: int = 512
-    steps: int = 20
+    steps: int = 12  # DPM++ 2M Karras converges in ~10-15 steps
     cfg_scale: float = 7.5
     seed: int = -1  # -1 means random seed
+    format: str = "png"  # png / webp / jpeg - webp encodes faster and is ~5x smaller
 
 class ModelSwitchRequest(BaseModel):
     model_name: str
 
+# (name, type, description, resolution) for the hub models and each checkpoint folder
+BUILTIN_MODELS = {
+    "sd15": ("Stable Diffusion v1.5", "sd15", "Base Stable Diffusion v1.5 model", "512x512"),
+    "sd_turbo": ("SD Turbo", "sd_turbo", "Distilled 1-4 step Stable Diffusion model", "512x512"),
+    "sdxl_turbo": ("SDXL Turbo", "sdxl_turbo", "Fast SDXL variant - 4GB GPU optimized", "512x512"),
+}
+CHECKPOINT_DIRS = (
+    ("/app/models/sdxl", ("SDXL {}", "sdxl", "SDXL model (CPU fallback for stability)", "768x768")),
+    ("/app/models", ("SD 1.5 {}", "sd15", "Custom Stable Diffusion v1.5 model", "512x512")),
+)
+
+def model_entry(template, path: str, loaded: bool = False, label: str = ""):
+    """Build an available_models entry from a (name, type, description, resolution) template"""
+    name, model_type, description, resolution = template
+    return {
+        "name": name.format(label),
+        "path": path,
+        "type": model_type,
+        "description": description,
+        "resolution": resolution,
+        "loaded": loaded
+    }
+
+def directory_mtime(directory: str):
+    """Directory mtime, which changes whenever a file is added, removed or renamed in it"""
+    try:
+        return os.stat(directory).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+@lru_cache(maxsize=8)
+def scan_safetensors(directory: str, mtime_ns=None):
+    """(name, path) for each .safetensors file in a directory - cached until the directory's mtime changes"""
+    try:
+        with os.scandir(directory) as entries:
+            return tuple((e.name[:-len(".safetensors")], e.path) for e in entries
+                         if e.name.endswith(".safetensors") and e.is_file())
+    except FileNotFoundError:
+        return ()
+
 def discover_models():
     """Discover available SD models in the models directory"""
     global available_models
     
-    # Default SD 1.5 (always available as it's loaded in the container)
-    available_models["stable-diffusion-v1-5"] = {
-        "name": "Stable Diffusion v1.5",
-        "path": "runwayml/stable-diffusion-v1-5",
-        "type": "sd15",
-        "description": "Base Stable Diffusion v1.5 model",
-        "resolution": "512x512",
-        "loaded": True
-    }
+    loaded_model = current_model or DEFAULT_MODEL
+    
+    # Startup model (SD 1.5 unless SD_MODEL_ID points at another checkpoint).
+    # A consolidated local checkpoint replaces the sharded weight downloads; its pipeline config still
+    # comes from the hub cache, revalidated only on the first load (or never with HF_HUB_OFFLINE=1)
+    default_path = SD_MODEL_ID
+    if DEFAULT_MODEL_TYPE == "sd15" and os.path.isfile(BASE_CHECKPOINT):
+        default_path = BASE_CHECKPOINT
+    available_models[DEFAULT_MODEL] = model_entry(
+        BUILTIN_MODELS[DEFAULT_MODEL_TYPE], default_path, loaded_model == DEFAULT_MODEL
+    )
     
     # SDXL Turbo - Fast SDXL variant optimized for 4GB VRAM
-    available_models["sdxl-turbo"] = {
-        "name": "SDXL Turbo",
-        "path": "stabilityai/sdxl-turbo", 
-        "type": "sdxl_turbo",
-        "description": "Fast SDXL variant - 4GB GPU optimized",
-        "resolution": "512x512",
-        "loaded": False
-    }
+    available_models["sdxl-turbo"] = model_entry(
+        BUILTIN_MODELS["sdxl_turbo"], "stabilityai/sdxl-turbo", loaded_model == "sdxl-turbo"
+    )
     
-    # Look for SDXL models
-    sdxl_models = glob.glob("/app/models/sdxl/*.safetensors")
-    for model_path in sdxl_models:
-        model_name = os.path.basename(model_path).replace('.safetensors', '')
-        available_models[model_name] = {
-            "name": f"SDXL {model_name}",
-            "path": model_path,
-            "type": "sdxl",
-            "description": "SDXL model (CPU fallback for stability)",
-            "resolution": "768x768",  
-            "loaded": False
-        }
-    
-    # Look for custom SD 1.5 models
-    sd15_models = glob.glob("/app/models/*.safetensors")
-    for model_path in sd15_models:
-        model_name = os.path.basename(model_path).replace('.safetensors', '')
-        if model_name not in available_models:
-            available_models[model_name] = {
-                "name": f"SD 1.5 {model_name}",
-                "path": model_path,
-                "type": "sd15",
-                "description": "Custom Stable Diffusion v1.5 model",
-                "resolution": "512x512",
-                "loaded": False
-            }
+    # SDXL models, then custom SD 1.5 models - earlier entries win on name clashes
+    seen = {DEFAULT_MODEL, "sdxl-turbo"}
+    for directory, template in CHECKPOINT_DIRS:
+        for model_name, model_path in scan_safetensors(directory, directory_mtime(directory)):
+            if model_name not in seen and model_path != BASE_CHECKPOINT:
+                seen.add(model_name)
+                available_models[model_name] = model_entry(
+                    template, model_path, loaded_model == model_name, model_name
+                )
     
     logger.info(f"Discovered {len(available_models)} models: {list(available_models.keys())}")
+    model_listing.cache_clear()
     return available_models
 
-def check_vram_availability():
-    """Check available VRAM and recommend offloading strategy"""
+@lru_cache(maxsize=1)
+def model_listing():
+    """Build the /sdapi/v1/sd-models response (cleared whenever available_models changes)"""
+    return [
+        {
+            "model_name": name,
+            "title": info["name"],
+            "hash": "local",
+            "type": info["type"],
+            "description": info["description"],
+            "resolution": info["resolution"],
+            "loaded": info["loaded"]
+        }
+        for name, info in available_models.items()
+    ]
+
+def to_json(obj) -> str:
+    """Serialize to a JSON string, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+def json_response(body: dict):
+    """Serialize a response body once instead of going through FastAPI's encoder"""
+    if orjson is not None:
+        return Response(content=orjson.dumps(body), media_type="application/json")
+    return Response(content=json.dumps(body), media_type="application/json")
+
+def encode_image(image, fmt: str = "png"):
+    """Encode a PIL image to bytes in the requested format"""
+    buffer = io.BytesIO()
+    fmt = fmt.lower()
+    if fmt == "webp":
+        image.save(buffer, format="WEBP", quality=92, method=4)
+    elif fmt in ("jpeg", "jpg"):
+        image.save(buffer, format="JPEG", quality=92)
+    else:
+        # zlib level 1 encodes several times faster than PIL's default for a slightly larger file
+        image.save(buffer, format="PNG", compress_level=1)
+    
+    # BytesIO.getvalue() shares the internal buffer instead of copying it
+    return buffer.getvalue()
+
+def image_media_type(fmt: str):
+    """Content type for an encode_image() format"""
+    fmt = fmt.lower()
+    if fmt == "webp":
+        return "image/webp"
+    if fmt in ("jpeg", "jpg"):
+        return "image/jpeg"
+    return "image/png"
+
+def to_base64(data: bytes) -> str:
+    """Base64-encode image bytes, with pybase64 when it is installed"""
+    if pybase64 is not None:
+        return pybase64.b64encode_as_string(data)
+    return base64.b64encode(data).decode()
+
+@lru_cache(maxsize=8)
+def get_font(size: int):
+    """Load the overlay font once per size"""
+    try:
+        return ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", size)
+    except Exception:
+        return ImageFont.load_default()
+
+def check_vram_availability(max_age: float = 0.0):
+    """Check available VRAM and recommend offloading strategy (reusing a reading up to max_age seconds old)"""
+    global vram_status, vram_checked_at
+    
+    if vram_status is not None and time.monotonic() - vram_checked_at < max_age:
+        return vram_status
+    
+    status = {"total": 0, "free": 0, "allocated": 0, "can_load_sdxl": False, "should_offload": True}
     try:
         if torch.cuda.is_available():
             total_vram = torch.cuda.get_device_properties(0).total_memory / 1024**3
@@ -97,9 +265,9 @@ def check_vram_availability():
             reserved_vram = torch.cuda.memory_reserved(0) / 1024**3
             free_vram = total_vram - reserved_vram
             
-            logger.info(f"📊 VRAM Status: {allocated_vram:.1f}GB used, {free_vram:.1f}GB free, {total_vram:.1f}GB total")
+            logger.debug(f"📊 VRAM Status: {allocated_vram:.1f}GB used, {free_vram:.1f}GB free, {total_vram:.1f}GB total")
             
-            return {
+            status = {
                 "total": total_vram,
                 "free": free_vram,
                 "allocated": allocated_vram,
@@ -109,65 +277,98 @@ def check_vram_availability():
     except Exception as e:
         logger.warning(f"Could not check VRAM: {e}")
     
-    return {"total": 0, "free": 0, "allocated": 0, "can_load_sdxl": False, "should_offload": True}
+    vram_status, vram_checked_at = status, time.monotonic()
+    return status
 
-def apply_comfyui_style_optimizations(pipeline, model_type: str, vram_info: dict):
+def keep_unet_resident(pipeline, device):
+    """Offload only the text encoders and VAE, keeping the U-Net on the GPU for the whole denoising loop"""
+    from accelerate import cpu_offload_with_hook
+    
+    # Each hook offloads the previous component when the next one runs: VAE -> text encoders -> U-Net
+    hook = None
+    for name in ("vae", "text_encoder", "text_encoder_2"):
+        module = getattr(pipeline, name, None)
+        if module is not None:
+            _, hook = cpu_offload_with_hook(module, device, prev_module_hook=hook)
+    # The U-Net's own hook is never offloaded, so it stays resident after the first step
+    cpu_offload_with_hook(pipeline.unet, device, prev_module_hook=hook)
+    return pipeline
+
+def enable_smart_offload(pipeline, device, free_vram: float):
+    """Pick the lightest offload strategy that fits the free VRAM"""
+    if free_vram >= 2.5:
+        try:
+            keep_unet_resident(pipeline, device)
+            logger.info("✅ U-Net kept in VRAM, text encoders/VAE offloaded")
+            return pipeline
+        except Exception as e:
+            logger.warning(f"Resident U-Net offload failed: {e}")
+    
+    if free_vram >= 1.5:
+        try:
+            # One transfer per component per generation instead of per layer per step
+            pipeline.enable_model_cpu_offload()
+            logger.info("✅ Model CPU offload enabled")
+            return pipeline
+        except Exception as e:
+            logger.warning(f"Model offload failed: {e}")
+    
+    try:
+        # Sequential CPU offloading - only when not even one component fits
+        pipeline.enable_sequential_cpu_offload()
+        logger.info("✅ Sequential CPU offload enabled (like ComfyUI)")
+    except Exception as e:
+        logger.warning(f"Sequential offload failed: {e}")
+    return pipeline
+
+def apply_comfyui_style_optimizations(pipeline, model_type: str, vram_info: dict, device=None):
     """Apply ComfyUI-style memory optimizations"""
-    device = pipeline.device
+    # The pipeline is still on the CPU when an offload hook is about to be installed
+    device = torch.device(device) if device is not None else pipeline.device
     
     if device.type == "cuda":
         logger.info("🔧 Applying ComfyUI-style VRAM optimizations...")
         
-        # Always enable attention slicing (ComfyUI equivalent)
+        # Fused SDPA attention for every model - already memory efficient, so no slicing on top of it
         try:
-            pipeline.enable_attention_slicing("max")
-            logger.info("✅ Max attention slicing enabled")
+            from diffusers.models.attention_processor import AttnProcessor2_0
+            pipeline.unet.set_attn_processor(AttnProcessor2_0())
+            logger.info("✅ Memory efficient attention processor enabled")
         except Exception as e:
-            logger.warning(f"Attention slicing failed: {e}")
+            logger.warning(f"SDPA attention not available, using attention slicing: {e}")
+            try:
+                pipeline.enable_attention_slicing("max")
+                logger.info("✅ Max attention slicing enabled")
+            except Exception as e2:
+                logger.warning(f"Attention slicing failed: {e2}")
         
-        # VAE optimizations for memory efficiency
+        # VAE optimizations for memory efficiency - each costs decode time, so only where they save an OOM.
+        # Tiling depends on the requested size, so generate_batch toggles it per batch
         if hasattr(pipeline, 'vae'):
             try:
-                if hasattr(pipeline.vae, 'enable_slicing'):
+                # Slicing only helps when several images are decoded together
+                if MAX_BATCH > 1 and hasattr(pipeline.vae, 'enable_slicing'):
                     pipeline.vae.enable_slicing()
                     logger.info("✅ VAE slicing enabled")
-                
-                if hasattr(pipeline.vae, 'enable_tiling'):
-                    pipeline.vae.enable_tiling()
-                    logger.info("✅ VAE tiling enabled")
             except Exception as e:
                 logger.warning(f"VAE optimizations failed: {e}")
         
         # Smart offloading based on VRAM availability (ComfyUI style)
         if vram_info["should_offload"] or model_type == "sdxl":
             logger.info("🧠 Enabling smart model offloading (ComfyUI style)...")
-            
-            try:
-                # Sequential CPU offloading - moves model parts to CPU when not in use
-                pipeline.enable_sequential_cpu_offload()
-                logger.info("✅ Sequential CPU offload enabled (like ComfyUI)")
-            except Exception as e:
-                logger.warning(f"Sequential offload failed: {e}")
-                try:
-                    # Fallback to model offloading
-                    pipeline.enable_model_cpu_offload()
-                    logger.info("✅ Model CPU offload enabled (fallback)")
-                except Exception as e2:
-                    logger.warning(f"Model offload also failed: {e2}")
-        
-        # SDXL Turbo specific optimizations for GPU
-        if model_type == "sdxl_turbo" and device.type == "cuda":
-            logger.info("⚡ Applying SDXL Turbo GPU optimizations...")
-            
-            try:
-                # Additional memory efficient attention for Turbo
-                if hasattr(pipeline.unet, 'set_attn_processor'):
-                    from diffusers.models.attention_processor import AttnProcessor2_0
-                    pipeline.unet.set_attn_processor(AttnProcessor2_0())
-                    logger.info("✅ Memory efficient attention processor enabled")
-                    
-            except Exception as e:
-                logger.warning(f"SDXL Turbo optimizations failed: {e}")
+            pipeline = enable_smart_offload(pipeline, device, vram_info["free"])
+        
+        # NHWC lets cuDNN pick tensor-core fp16 conv kernels (not with per-layer offload hooks)
+        if pipeline.unet.dtype == torch.float16 and next(pipeline.unet.parameters()).device.type != "meta":
+            pipeline.unet.to(memory_format=torch.channels_last)
+            pipeline.vae.to(memory_format=torch.channels_last)
+            logger.info("✅ channels_last memory format enabled")
+    
+    # Offload hooks move weights between devices inside forward, which breaks compiled graphs (and CUDA
+    # graph capture) - skipped just like in load_pipeline. Sequential offload leaves weights on the meta device
+    offloaded = hasattr(pipeline.unet, "_hf_hook") or next(pipeline.unet.parameters()).device.type == "meta"
+    if COMPILE_MODEL and not offloaded:
+        pipeline = compile_pipeline(pipeline)
     
     return pipeline
 
@@ -190,40 +391,22 @@ def load_model(model_name: str):
     if pipeline is not None:
         logger.info("🧹 Cleaning up previous model...")
         
-        # Move pipeline to CPU first to free VRAM immediately
-        try:
-            pipeline = pipeline.to("cpu")
-        except:
-            pass
-        
-        # Delete pipeline components individually
-        try:
-            if hasattr(pipeline, 'unet'):
-                del pipeline.unet
-            if hasattr(pipeline, 'vae'):
-                del pipeline.vae
-            if hasattr(pipeline, 'text_encoder'):
-                del pipeline.text_encoder
-        except:
-            pass
+        # Drop every component where it lives - copying weights to the CPU just to free them is wasted work
+        for name, component in list(pipeline.components.items()):
+            if isinstance(component, torch.nn.Module):
+                try:
+                    delattr(pipeline, name)
+                except Exception:
+                    pass
             
         del pipeline
         pipeline = None
         
-        # Aggressive memory cleanup
-        torch.cuda.empty_cache()
-        torch.cuda.synchronize()
-        
+        # One cleanup pass - with expandable segments freed blocks are reusable right away
         import gc
         gc.collect()
-        
-        # Multiple cleanup rounds for SDXL
-        if model_type == "sdxl":
-            logger.info("🔧 Extra cleanup for SDXL loading...")
+        if torch.cuda.is_available():
             torch.cuda.empty_cache()
-            gc.collect()
-            import time
-            time.sleep(2)  # Give more time for SDXL
     
     logger.info(f"Loading model: {model_info['name']}")
     
@@ -235,7 +418,8 @@ def load_model(model_name: str):
         # SDXL runs on CPU for stability (SDXL Turbo is the GPU option)
         logger.info("🔧 Loading SDXL on CPU for stability (use SDXL Turbo for GPU)")
         device = "cpu"
-        torch_dtype = torch.float32
+        # BF16 halves the weight bytes streamed per step on CPUs with native BF16 support
+        torch_dtype = torch.bfloat16 if cpu_supports_bf16() else torch.float32
         
         # Check system RAM for CPU loading
         import psutil
@@ -246,7 +430,7 @@ def load_model(model_name: str):
         if available_ram_gb < min_ram_for_sdxl:
             raise ValueError(f"❌ Insufficient system RAM ({available_ram_gb:.1f}GB) for SDXL CPU. Need at least {min_ram_for_sdxl}GB available.")
         
-        logger.info(f"✅ Loading SDXL on CPU with {available_ram_gb:.1f}GB RAM available")
+        logger.info(f"✅ Loading SDXL on CPU ({str(torch_dtype).replace('torch.', '')}) with {available_ram_gb:.1f}GB RAM available")
     
     elif model_type == "sdxl_turbo":
         # SDXL Turbo is very 4GB-friendly
@@ -276,6 +460,8 @@ def load_model(model_name: str):
         load_kwargs = {
             "torch_dtype": torch_dtype,
             "use_safetensors": True,
+            # from_single_file still fetches the pipeline config from the hub
+            "local_files_only": HF_OFFLINE or (model_info["path"], None) in downloaded_models,
         }
         
         # CPU optimizations
@@ -283,15 +469,12 @@ def load_model(model_name: str):
             logger.info("🔧 Applying CPU-specific SDXL optimizations...")
             load_kwargs.update({
                 "low_cpu_mem_usage": True,
-                "load_in_4bit": False,  # Disable quantization for stability
-                "torch_dtype": torch.float32,  # Use float32 for CPU
             })
             # Don't use device_map for CPU as it can cause issues
         elif device == "cuda":
             # GPU with aggressive offloading
             load_kwargs.update({
                 "device_map": "auto",
-                "max_memory": {0: "1GB", "cpu": "6GB"},  # Limit GPU memory, use CPU for overflow
             })
         else:
             load_kwargs["variant"] = "fp16" if torch_dtype == torch.float16 else None
@@ -300,12 +483,15 @@ def load_model(model_name: str):
             model_info["path"],
             **load_kwargs
         )
+        downloaded_models.add((model_info["path"], None))
     elif model_info["type"] == "sdxl_turbo":
         from diffusers import AutoPipelineForText2Image
         
         # SDXL Turbo optimized loading
         load_kwargs = {
             "torch_dtype": torch_dtype,
+            "use_safetensors": True,
+            "local_files_only": HF_OFFLINE or (model_info["path"], None) in downloaded_models,
         }
         
         # Device-specific optimizations - simplified for SDXL Turbo
@@ -323,31 +509,42 @@ def load_model(model_name: str):
             model_info["path"],
             **load_kwargs
         )
+        downloaded_models.add((model_info["path"], None))
     else:  # SD 1.5
         from diffusers import StableDiffusionPipeline
-        if model_name == "stable-diffusion-v1-5":
-            # Use HuggingFace model
+        if not model_info["path"].endswith(".safetensors"):
+            # Use HuggingFace model - the fp16 variant is separate files, so it is tracked separately
+            variant = "fp16" if torch_dtype == torch.float16 else None
             pipeline = StableDiffusionPipeline.from_pretrained(
                 model_info["path"],
                 torch_dtype=torch_dtype,
                 safety_checker=None,
                 requires_safety_checker=False,
-                variant="fp16" if torch_dtype == torch.float16 else None
+                variant=variant,
+                low_cpu_mem_usage=True,
+                use_safetensors=True,
+                local_files_only=HF_OFFLINE or (model_info["path"], variant) in downloaded_models
             )
+            downloaded_models.add((model_info["path"], variant))
         else:
-            # Use local safetensors file
+            # Use local safetensors file (the pipeline config still comes from the hub cache)
             pipeline = StableDiffusionPipeline.from_single_file(
                 model_info["path"],
                 torch_dtype=torch_dtype,
                 safety_checker=None,
-                requires_safety_checker=False
+                requires_safety_checker=False,
+                local_files_only=HF_OFFLINE or (model_info["path"], None) in downloaded_models
             )
+            downloaded_models.add((model_info["path"], None))
     
-    # Move to device initially
-    pipeline = pipeline.to(device)
+    pipeline = configure_scheduler(pipeline, model_type)
+    
+    # Move to device, unless offload hooks will manage placement (moving first defeats the offload)
+    if not (device == "cuda" and (vram_info["should_offload"] or model_type == "sdxl")):
+        pipeline = pipeline.to(device)
     
     # Apply ComfyUI-style optimizations
-    pipeline = apply_comfyui_style_optimizations(pipeline, model_type, vram_info)
+    pipeline = apply_comfyui_style_optimizations(pipeline, model_type, vram_info, device)
     
     current_model = model_name
     available_models[model_name]["loaded"] = True
@@ -356,6 +553,14 @@ def load_model(model_name: str):
     for name in available_models:
         if name != model_name:
             available_models[name]["loaded"] = False
+    model_listing.cache_clear()
+    result_cache.clear()
+    embeds_cache.clear()
+    reset_generators(pipeline._execution_device)
+    
+    # Pay the compile cost now rather than on the first request
+    if COMPILE_MODEL:
+        warmup_pipeline()
     
     # Log final VRAM usage
     final_vram = check_vram_availability()
@@ -382,15 +587,205 @@ def detect_compute_device():
             except Exception as e:
                 logger.warning(f"⚠️ GPU detected but not accessible: {e}")
                 logger.info("🔄 Falling back to CPU")
+        
+        # Apple Silicon GPU
+        if torch.backends.mps.is_available():
+            logger.info("🍎 Apple MPS device detected")
+            return "mps", torch.float32
     except Exception as e:
         logger.info(f"🔍 CUDA check failed: {e}")
     
-    # Fallback to CPU
+    # Fallback to CPU - BF16 halves memory traffic where the CPU supports it natively
     device = "cpu"
-    torch_dtype = torch.float32
-    logger.info("🔧 Using CPU (portable mode)")
+    if cpu_supports_bf16():
+        torch_dtype = torch.bfloat16
+        logger.info("🔧 Using CPU with native BF16 (portable mode)")
+    else:
+        torch_dtype = torch.float32
+        logger.info("🔧 Using CPU (portable mode)")
     return device, torch_dtype
 
+def cpu_supports_bf16():
+    """Check whether the CPU has native BF16 instructions (avx512_bf16, or AMX - every AMX CPU has amx_bf16)"""
+    # Plain AVX-512 only emulates BF16 (slower than FP32), so oneDNN's broader bf16 check is not enough
+    try:
+        if torch.cpu._is_avx512_bf16_supported():
+            return True
+        return bool(torch.cpu._is_amx_tile_supported())
+    except AttributeError:
+        return False
+
+def configure_scheduler(pipeline, model_type: str):
+    """Pick the scheduler for a freshly loaded pipeline"""
+    global lcm_enabled
+    lcm_enabled = False
+    
+    # Turbo models are distilled for their bundled scheduler
+    if model_type in ("sd_turbo", "sdxl_turbo"):
+        return pipeline
+    
+    if LCM_LORA and model_type == "sd15":
+        try:
+            from diffusers import LCMScheduler
+            pipeline.load_lora_weights("latent-consistency/lcm-lora-sdv1-5")
+            pipeline.fuse_lora()
+            pipeline.scheduler = LCMScheduler.from_config(pipeline.scheduler.config)
+            lcm_enabled = True
+            logger.info("✅ LCM-LoRA loaded (4-8 step generation)")
+            return pipeline
+        except Exception as e:
+            logger.warning(f"⚠️ LCM-LoRA failed, using DPM++ instead: {e}")
+    
+    return use_fast_scheduler(pipeline)
+
+def use_fast_scheduler(pipeline):
+    """Swap in DPM-Solver++ 2M Karras, which needs roughly half the steps of PNDM/Euler"""
+    try:
+        from diffusers import DPMSolverMultistepScheduler
+        pipeline.scheduler = DPMSolverMultistepScheduler.from_config(
+            pipeline.scheduler.config,
+            algorithm_type="dpmsolver++",
+            use_karras_sigmas=True
+        )
+        logger.info("✅ DPM++ 2M Karras scheduler enabled")
+    except Exception as e:
+        logger.warning(f"⚠️ Could not switch scheduler: {e}")
+    return pipeline
+
+def enable_fast_attention(pipeline, device: str):
+    """Use fused attention kernels, falling back to attention slicing only when they are unavailable"""
+    if device == "cuda":
+        try:
+            pipeline.enable_xformers_memory_efficient_attention()
+            logger.info("✅ xformers memory efficient attention enabled")
+            return
+        except Exception as e:
+            logger.info(f"xformers not available ({e}), using PyTorch SDPA")
+    
+    try:
+        from diffusers.models.attention_processor import AttnProcessor2_0
+        pipeline.unet.set_attn_processor(AttnProcessor2_0())
+        logger.info("✅ Fused SDPA attention enabled")
+    except Exception as e:
+        logger.warning(f"⚠️ SDPA attention not available, falling back to attention slicing: {e}")
+        pipeline.enable_attention_slicing()
+
+def compile_pipeline(pipeline):
+    """Compile the U-Net (and VAE decoder) with torch.compile when enabled"""
+    if not COMPILE_MODEL:
+        return pipeline
+    
+    if not hasattr(torch, "compile"):
+        logger.warning("⚠️ torch.compile requires PyTorch 2.x - running in eager mode")
+        return pipeline
+    
+    try:
+        pipeline.unet.to(memory_format=torch.channels_last)
+        pipeline.unet = torch.compile(pipeline.unet, mode=COMPILE_MODE, fullgraph=True)
+        pipeline.vae.decode = torch.compile(pipeline.vae.decode, mode=COMPILE_MODE)
+        logger.info(f"✅ U-Net compiled with torch.compile (mode={COMPILE_MODE})")
+    except Exception as e:
+        logger.warning(f"⚠️ torch.compile failed, running in eager mode: {e}")
+    
+    return pipeline
+
+def aot_compile_unet(pipeline, model_id: str, width: int = 512, height: int = 512):
+    """Replace the U-Net forward with an AOTInductor package, built once and cached on disk"""
+    if not AOT_UNET:
+        return pipeline
+    
+    if not hasattr(torch._inductor, "aoti_compile_and_package"):
+        logger.warning("⚠️ AOTInductor requires PyTorch 2.6+ - running in eager mode")
+        return pipeline
+    
+    unet = pipeline.unet
+    device = pipeline.device
+    latent_shape = (unet.config.in_channels, height // pipeline.vae_scale_factor, width // pipeline.vae_scale_factor)
+    key = hashlib.sha1(repr((model_id, str(unet.dtype), device.type, latent_shape)).encode()).hexdigest()[:16]
+    package_path = os.path.join(AOT_CACHE_DIR, f"unet-{key}.pt2")
+    
+    try:
+        if not os.path.exists(package_path):
+            logger.info(f"🔨 Exporting U-Net with AOTInductor for {width}x{height} (one-time)...")
+            start = time.perf_counter()
+            
+            class UNetForward(torch.nn.Module):
+                def __init__(self, unet):
+                    super().__init__()
+                    self.unet = unet
+                
+                def forward(self, sample, timestep, encoder_hidden_states):
+                    return self.unet(sample, timestep, encoder_hidden_states=encoder_hidden_states, return_dict=False)[0]
+            
+            # Batch is dynamic: CFG doubles it and micro-batching multiplies it
+            sample = torch.randn((2, *latent_shape), device=device, dtype=unet.dtype)
+            timestep = torch.tensor(999, device=device)
+            encoder_hidden_states = torch.randn(
+                (2, pipeline.tokenizer.model_max_length, unet.config.cross_attention_dim),
+                device=device,
+                dtype=unet.dtype
+            )
+            batch = torch.export.Dim("batch", min=1, max=2 * MAX_BATCH)
+            with torch.no_grad():
+                exported = torch.export.export(
+                    UNetForward(unet),
+                    (sample, timestep, encoder_hidden_states),
+                    dynamic_shapes={"sample": {0: batch}, "timestep": None, "encoder_hidden_states": {0: batch}}
+                )
+                os.makedirs(AOT_CACHE_DIR, exist_ok=True)
+                torch._inductor.aoti_compile_and_package(exported, package_path=package_path)
+            logger.info(f"✅ AOTInductor package saved to {package_path} in {time.perf_counter() - start:.0f}s")
+        
+        compiled = torch._inductor.aoti_load_package(package_path)
+    except Exception as e:
+        logger.warning(f"⚠️ AOTInductor export failed, running in eager mode: {e}")
+        return pipeline
+    
+    eager_forward = unet.forward
+    
+    def forward(sample, timestep, encoder_hidden_states, timestep_cond=None, attention_mask=None,
+                cross_attention_kwargs=None, added_cond_kwargs=None, return_dict=True, **kwargs):
+        # Anything the package wasn't exported for (other resolutions, extra conditioning) runs eagerly
+        if (tuple(sample.shape[1:]) != latent_shape or not torch.is_tensor(timestep) or timestep.dim() != 0
+                or timestep_cond is not None or attention_mask is not None or cross_attention_kwargs
+                or added_cond_kwargs or kwargs):
+            return eager_forward(sample, timestep, encoder_hidden_states, timestep_cond=timestep_cond,
+                                 attention_mask=attention_mask, cross_attention_kwargs=cross_attention_kwargs,
+                                 added_cond_kwargs=added_cond_kwargs, return_dict=return_dict, **kwargs)
+        
+        out = compiled(sample, timestep.to(device=sample.device, dtype=torch.int64), encoder_hidden_states)
+        if return_dict:
+            from diffusers.models.unets.unet_2d_condition import UNet2DConditionOutput
+            return UNet2DConditionOutput(sample=out)
+        return (out,)
+    
+    unet.forward = forward
+    logger.info("✅ AOTInductor U-Net loaded")
+    return pipeline
+
+@contextmanager
+def inference_context():
+    """Grad-free context for pipeline calls, with BF16 autocast for CPU pipelines loaded in BF16"""
+    # Warm-up and real batches must share it - compiled graphs are guarded on the grad/autocast state
+    cpu_bf16 = pipeline.device.type == "cpu" and pipeline.dtype == torch.bfloat16
+    with torch.inference_mode(), torch.autocast("cpu", dtype=torch.bfloat16, enabled=cpu_bf16):
+        yield
+
+def warmup_pipeline(width: int = 512, height: int = 512):
+    """Run a throwaway generation at the common request size so the first real request doesn't pay compile/autotune cost"""
+    if pipeline is None:
+        return
+    
+    logger.info("🔥 Warming up pipeline...")
+    start = time.perf_counter()
+    try:
+        with inference_context():
+            # Two steps reach the multistep solver path; default CFG keeps the U-Net batch shape of real requests
+            pipeline(prompt="warmup", num_inference_steps=2, width=width, height=height)
+        logger.info(f"✅ Warm-up finished in {time.perf_counter() - start:.1f}s")
+    except Exception as e:
+        logger.warning(f"⚠️ Warm-up failed: {e}")
+
 def load_pipeline():
     """Load the Stable Diffusion pipeline with smart device detection"""
     global pipeline
@@ -401,35 +796,59 @@ def load_pipeline():
         device, torch_dtype = detect_compute_device()
         
         logger.info("📦 Loading Stable Diffusion pipeline...")
-        model_id = "runwayml/stable-diffusion-v1-5"
-        
-        # Load with device-specific settings
-        pipeline = StableDiffusionPipeline.from_pretrained(
-            model_id,
-            torch_dtype=torch_dtype,
-            safety_checker=None,
-            requires_safety_checker=False
-        )
+        model_id = available_models.get(DEFAULT_MODEL, {}).get("path", SD_MODEL_ID)
         
-        pipeline = pipeline.to(device)
+        # Load with device-specific settings (safetensors are mmapped instead of unpickled)
+        if model_id.endswith(".safetensors"):
+            pipeline = StableDiffusionPipeline.from_single_file(
+                model_id,
+                torch_dtype=torch_dtype,
+                safety_checker=None,
+                requires_safety_checker=False,
+                local_files_only=HF_OFFLINE or (model_id, None) in downloaded_models
+            )
+            downloaded_models.add((model_id, None))
+        else:
+            pipeline = StableDiffusionPipeline.from_pretrained(
+                model_id,
+                torch_dtype=torch_dtype,
+                safety_checker=None,
+                requires_safety_checker=False,
+                low_cpu_mem_usage=True,
+                use_safetensors=True,
+                local_files_only=HF_OFFLINE or (model_id, None) in downloaded_models
+            )
+            downloaded_models.add((model_id, None))
+        pipeline = configure_scheduler(pipeline, DEFAULT_MODEL_TYPE)
+        
+        # Keep components on the CPU between uses when VRAM is tight, otherwise move everything
+        vram_info = check_vram_availability()
+        offload = device == "cuda" and vram_info["should_offload"]
+        if offload:
+            pipeline = enable_smart_offload(pipeline, device, vram_info["free"])
+        else:
+            pipeline = pipeline.to(device)
         
         # Apply device-specific optimizations
+        enable_fast_attention(pipeline, device)
         if device == "cuda":
-            # GPU optimizations
-            try:
-                pipeline.enable_attention_slicing()
-                pipeline.enable_memory_efficient_attention()
-                logger.info("✅ GPU optimizations enabled")
-            except Exception as e:
-                logger.warning(f"⚠️ Some GPU optimizations failed: {e}")
-                pipeline.enable_attention_slicing()  # Fallback to basic optimization
-        else:
-            # CPU optimizations
-            pipeline.enable_attention_slicing()
-            logger.info("✅ CPU optimizations enabled")
+            logger.info("✅ GPU optimizations enabled")
+        elif device == "cpu":
+            # CPU optimizations - channels_last lets convolutions hit the oneDNN fast path
+            pipeline.unet.to(memory_format=torch.channels_last)
+            pipeline.vae.to(memory_format=torch.channels_last)
+            logger.info(f"✅ CPU optimizations enabled ({str(torch_dtype).replace('torch.', '')})")
+        
+        # Offload hooks move weights between devices, which breaks compiled graphs
+        if not offload:
+            if COMPILE_MODEL:
+                pipeline = compile_pipeline(pipeline)
+            else:
+                pipeline = aot_compile_unet(pipeline, model_id)
+        reset_generators(pipeline._execution_device)
         
         # Performance estimate
-        if device == "cuda":
+        if device in ("cuda", "mps"):
             logger.info("⚡ Expected generation time: ~10-30 seconds per image")
         else:
             logger.info("🕒 Expected generation time: ~3-4 minutes per image")
@@ -445,11 +864,33 @@ def load_pipeline():
 async def startup_event():
     """Load the model on startup"""
     logger.info("Starting up SD server...")
+    global current_model, batch_queue, batch_task, pipeline_lock
+    
+    # One intra-op pool sized to the cores we can use, no nested inter-op parallelism
+    try:
+        cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        torch.set_num_threads(cpu_count)
+        torch.set_num_interop_threads(1)
+        logger.info(f"🧵 Torch threads: {cpu_count} intra-op, 1 inter-op")
+    except RuntimeError as e:
+        logger.warning(f"Could not configure torch threads: {e}")
+    
+    # Request shapes are stable, so let cuDNN pick and cache the fastest conv algorithms
+    torch.backends.cudnn.benchmark = True
+    torch.set_float32_matmul_precision("high")
+    
+    batch_queue = asyncio.Queue()
+    pipeline_lock = asyncio.Lock()
+    batch_task = asyncio.create_task(batch_worker())
+    
     discover_models()
-    current_model = "stable-diffusion-v1-5"
+    current_model = DEFAULT_MODEL
     success = load_pipeline()
     if not success:
         logger.warning("Failed to load SD pipeline, using fallback mode")
+    elif WARMUP or COMPILE_MODEL:
+        # cuDNN autotuning, allocator growth and any compilation happen here instead of on request #1
+        warmup_pipeline()
 
 @app.get("/sdapi/v1/progress")
 def progress():
@@ -458,18 +899,7 @@ def progress():
 @app.get("/sdapi/v1/sd-models")
 def models():
     """Return list of available models"""
-    return [
-        {
-            "model_name": name,
-            "title": info["name"],
-            "hash": "local",
-            "type": info["type"],
-            "description": info["description"],
-            "resolution": info["resolution"],
-            "loaded": info["loaded"]
-        }
-        for name, info in available_models.items()
-    ]
+    return model_listing()
 
 @app.get("/sdapi/v1/options")
 def get_options():
@@ -480,7 +910,7 @@ def get_options():
     }
 
 @app.post("/sdapi/v1/options")
-def set_options(options: dict):
+async def set_options(options: dict):
     """Set model options (including model switching)"""
     global current_model
     
@@ -488,7 +918,9 @@ def set_options(options: dict):
         new_model = options["sd_model_checkpoint"]
         if new_model != current_model:
             try:
-                load_model(new_model)
+                # Wait for the running batch so its pipeline isn't freed mid-step, then load on the pipeline thread
+                async with pipeline_lock:
+                    await asyncio.get_running_loop().run_in_executor(sd_executor, load_model, new_model)
                 return {"status": "success", "message": f"Switched to {new_model}"}
             except Exception as e:
                 return {"status": "error", "message": str(e)}
@@ -501,160 +933,312 @@ def refresh_checkpoints():
     discover_models()
     return {"status": "success", "message": "Models refreshed", "models": available_models}
 
-@app.post("/sdapi/v1/txt2img")
-def txt2img(request: ImageRequest):
-    global pipeline
-    
-    try:
-        if pipeline is None:
-            # Fallback to enhanced placeholder
-            return generate_enhanced_placeholder(request)
-        
-        # Handle seed generation
-        if request.seed == -1:
-            import random
-            seed = random.randint(0, 2**32 - 1)
+def encode_prompts(requests: List[ImageRequest]):
+    """Batch prompt embeddings as pipeline kwargs, reusing cached text encoder output for repeated prompts"""
+    device = pipeline._execution_device
+    encoded = []
+    for request in requests:
+        key = (current_model, request.prompt, request.negative_prompt)
+        if key in embeds_cache:
+            embeds_cache.move_to_end(key)
         else:
-            seed = request.seed
-            
-        # Pre-generation memory check and optimization
-        vram_info = check_vram_availability()
+            # SD 1.5 returns (embeds, negative); SDXL adds the pooled pair from its second text encoder.
+            # An empty negative goes in as None so SDXL zeroes it (force_zeros_for_empty_prompt)
+            embeds_cache[key] = pipeline.encode_prompt(
+                request.prompt,
+                device=device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=True,
+                negative_prompt=request.negative_prompt or None
+            )
+            if len(embeds_cache) > EMBEDS_CACHE_SIZE:
+                embeds_cache.popitem(last=False)
         
-        # Smart parameter optimization for SDXL Turbo 
-        if current_model and available_models.get(current_model, {}).get("type") == "sdxl_turbo":
-            # SDXL Turbo works best with 1-4 steps
-            if request.steps > 6:
-                logger.info(f"🔧 SDXL Turbo: reducing steps from {request.steps} to 4 for optimal speed")
-                request.steps = 4
-            # SDXL Turbo can handle larger sizes well on 4GB VRAM
-            if vram_info["free"] < 1.5:  # Very low VRAM
-                logger.info(f"🔧 Low VRAM ({vram_info['free']:.1f}GB) - using conservative resolution")
-                request.width = min(request.width, 512)
-                request.height = min(request.height, 512)
-        
-        # Pre-generation cleanup for maximum available memory
-        if vram_info["should_offload"]:
-            logger.info("🧹 Pre-generation memory cleanup...")
-            torch.cuda.empty_cache()
-            torch.cuda.synchronize()
-            import gc
-            gc.collect()
-                
+        encoded.append(embeds_cache[key])
+    
+    names = ("prompt_embeds", "negative_prompt_embeds", "pooled_prompt_embeds", "negative_pooled_prompt_embeds")
+    return {name: torch.cat(parts) for name, parts in zip(names, zip(*encoded))}
+
+def generate_batch(requests: List[ImageRequest], seeds: List[int]):
+    """Run one pipeline call for shape-compatible requests and return (PIL images, sampler/model info)"""
+    from diffusers import StableDiffusionPipeline, StableDiffusionXLPipeline
+    
+    vram_info = check_vram_availability(VRAM_CHECK_INTERVAL)
+    
+    # Pre-generation cleanup for maximum available memory (no gc.collect - refcounting already freed the tensors)
+    if torch.cuda.is_available() and vram_info["should_offload"]:
+        logger.debug("🧹 Pre-generation memory cleanup...")
+        torch.cuda.empty_cache()
+        torch.cuda.synchronize()
+    
+    first = requests[0]
+    for request, seed in zip(requests, seeds):
         logger.info(f"Generating image for prompt: {request.prompt}")
         if request.negative_prompt:
             logger.info(f"Negative prompt: {request.negative_prompt}")
         logger.info(f"Using seed: {seed}")
-        logger.info(f"Dimensions: {request.width}x{request.height}, Steps: {request.steps}")
-        
-        # Generate image using Stable Diffusion
-        with torch.no_grad():
-            result = pipeline(
-                prompt=request.prompt,
-                negative_prompt=request.negative_prompt if request.negative_prompt else None,
-                width=request.width,
-                height=request.height,
-                num_inference_steps=request.steps,
-                guidance_scale=request.cfg_scale,
-                generator=torch.Generator().manual_seed(seed)
-            )
+    logger.info(f"Dimensions: {first.width}x{first.height}, Steps: {first.steps}, Batch: {len(requests)}")
+    
+    # Tiled VAE decode for large images on a tight GPU - it costs decode time, so only where it saves an OOM
+    if pipeline._execution_device.type == "cuda" and hasattr(pipeline.vae, "enable_tiling"):
+        tile = first.width * first.height >= 768 * 768 and (vram_info["free"] < 4.0 or vram_info["should_offload"])
+        if tile != getattr(pipeline.vae, "use_tiling", False):
+            if tile:
+                pipeline.vae.enable_tiling()
+            else:
+                pipeline.vae.disable_tiling()
+            logger.info(f"🔧 VAE tiling {'enabled' if tile else 'disabled'} for {first.width}x{first.height}")
+    
+    # Generate images using Stable Diffusion
+    with inference_context():
+        # SD 1.5 and SDXL pipelines take precomputed embeddings, skipping the text encoders on repeats
+        if isinstance(pipeline, (StableDiffusionPipeline, StableDiffusionXLPipeline)):
+            prompt_kwargs = encode_prompts(requests)
+        else:
+            # Empty negatives stay None so SDXL can zero the negative embeddings (force_zeros_for_empty_prompt);
+            # batch_worker never mixes empty and non-empty negatives in one batch
+            prompt_kwargs = {
+                "prompt": [request.prompt for request in requests],
+                "negative_prompt": [request.negative_prompt for request in requests] if first.negative_prompt else None
+            }
         
-        # Get the generated image
-        image = result.images[0]
+        result = pipeline(
+            **prompt_kwargs,
+            width=first.width,
+            height=first.height,
+            num_inference_steps=first.steps,
+            guidance_scale=first.cfg_scale,
+            generator=[generators[i].manual_seed(seed) for i, seed in enumerate(seeds)]
+        )
+    
+    # Get the generated images
+    images = result.images
+    
+    # Post-generation cleanup (ComfyUI style)
+    if torch.cuda.is_available() and vram_info["should_offload"]:
+        logger.debug("🧹 Post-generation cleanup...")
+        del result
+        torch.cuda.empty_cache()
+    
+    # Read while the pipeline lock is held - a queued model switch replaces the pipeline right after
+    scheduler = type(pipeline.scheduler).__name__
+    meta = {"sampler": SAMPLER_NAMES.get(scheduler, scheduler), "model": current_model}
+    
+    return images, meta
+
+async def batch_worker():
+    """Collect queued txt2img jobs for a short window and run them as batches"""
+    loop = asyncio.get_running_loop()
+    while True:
+        jobs = [await batch_queue.get()]
+        deadline = loop.time() + BATCH_WINDOW
+        while len(jobs) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                jobs.append(await asyncio.wait_for(batch_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
         
-        # Post-generation cleanup (ComfyUI style)
-        if vram_info["should_offload"]:
-            logger.info("🧹 Post-generation cleanup...")
-            del result
-            torch.cuda.empty_cache()
-            import gc
-            gc.collect()
+        # Only requests with the same shape and sampling settings can share a pipeline call. Requests
+        # without a negative prompt are kept apart so their batch can pass negative_prompt=None
+        groups = {}
+        for job in jobs:
+            request = job[0]
+            key = (request.width, request.height, request.steps, request.cfg_scale, bool(request.negative_prompt))
+            groups.setdefault(key, []).append(job)
         
-        # Convert to base64
-        buffer = io.BytesIO()
-        image.save(buffer, format='PNG')
-        img_b64 = base64.b64encode(buffer.getvalue()).decode()
+        for group in groups.values():
+            try:
+                async with pipeline_lock:
+                    images, meta = await loop.run_in_executor(
+                        sd_executor,
+                        generate_batch,
+                        [request for request, _, _ in group],
+                        [seed for _, seed, _ in group]
+                    )
+                for (_, _, future), image in zip(group, images):
+                    if not future.done():
+                        future.set_result((image, meta))
+            except Exception as e:
+                for _, _, future in group:
+                    if not future.done():
+                        future.set_exception(e)
+
+async def generate_image(request: ImageRequest):
+    """Generate one image through the batch queue, returning (encoded bytes, seed, sampler/model info)"""
+    # Handle seed generation
+    if request.seed == -1:
+        import random
+        seed = random.randint(0, 2**32 - 1)
+    else:
+        seed = request.seed
         
-        # Final memory status
-        final_vram = check_vram_availability()
-        logger.info(f"✅ Image generated successfully! VRAM: {final_vram['allocated']:.1f}GB used, {final_vram['free']:.1f}GB free")
+    # Pre-generation memory check and optimization
+    vram_info = check_vram_availability(VRAM_CHECK_INTERVAL)
+    
+    # Smart parameter optimization for SDXL Turbo 
+    if current_model and available_models.get(current_model, {}).get("type") == "sdxl_turbo":
+        # SDXL Turbo works best with 1-4 steps
+        if request.steps > 6:
+            logger.info(f"🔧 SDXL Turbo: reducing steps from {request.steps} to 4 for optimal speed")
+            request.steps = 4
+        # SDXL Turbo can handle larger sizes well on 4GB VRAM
+        if vram_info["free"] < 1.5:  # Very low VRAM
+            logger.info(f"🔧 Low VRAM ({vram_info['free']:.1f}GB) - using conservative resolution")
+            request.width = min(request.width, 512)
+            request.height = min(request.height, 512)
+    
+    # Distilled checkpoints: SD Turbo runs 1-4 steps without CFG, LCM-LoRA 4-8 steps with low CFG
+    if current_model and available_models.get(current_model, {}).get("type") == "sd_turbo":
+        request.steps = min(request.steps, 4)
+        request.cfg_scale = 0.0
+    elif lcm_enabled:
+        request.steps = min(request.steps, 8)
+        request.cfg_scale = min(max(request.cfg_scale, 1.0), 2.0)
+    
+    # A fixed seed gives identical output, so those requests are served from the LRU cache
+    cache_key = (current_model, request.prompt, request.negative_prompt, request.width, request.height,
+                 request.steps, request.cfg_scale, seed, request.format)
+    if request.seed != -1 and cache_key in result_cache:
+        result_cache.move_to_end(cache_key)
+        logger.info(f"♻️ Serving cached image for prompt: {request.prompt}")
+        image_bytes, meta = result_cache[cache_key]
+        return image_bytes, seed, meta
+    
+    # Diffusion runs on the dedicated executor so /progress and health checks stay responsive
+    future = asyncio.get_running_loop().create_future()
+    await batch_queue.put((request, seed, future))
+    image, meta = await future
+    
+    # Encode on the default thread pool so the pipeline thread can start the next batch meanwhile
+    image_bytes = await asyncio.to_thread(encode_image, image, request.format)
+    
+    if request.seed != -1:
+        result_cache[cache_key] = (image_bytes, meta)
+        if len(result_cache) > RESULT_CACHE_SIZE:
+            result_cache.popitem(last=False)
+    
+    # Final memory status
+    final_vram = check_vram_availability(VRAM_CHECK_INTERVAL)
+    logger.debug(f"✅ Image generated successfully! VRAM: {final_vram['allocated']:.1f}GB used, {final_vram['free']:.1f}GB free")
+    
+    return image_bytes, seed, meta
+
+@app.post("/sdapi/v1/txt2img")
+async def txt2img(request: ImageRequest):
+    global pipeline
+    
+    try:
+        if pipeline is None:
+            # Fallback to enhanced placeholder, rendered off the event loop
+            return await asyncio.to_thread(generate_enhanced_placeholder, request)
         
-        return {
-            "images": [img_b64],
-            "parameters": {
-                "prompt": request.prompt,
-                "negative_prompt": request.negative_prompt,
-                "width": request.width,
-                "height": request.height,
-                "steps": request.steps,
-                "cfg_scale": request.cfg_scale,
-                "seed": seed
-            },
-            "info": json.dumps({
-                "prompt": request.prompt,
-                "negative_prompt": request.negative_prompt,
-                "width": request.width,
-                "height": request.height,
-                "steps": request.steps,
-                "cfg_scale": request.cfg_scale,
-                "seed": seed,
-                "sampler": "Euler",
-                "model": current_model,
-                "model_info": available_models.get(current_model, {})
-            })
+        image_bytes, seed, meta = await generate_image(request)
+        
+        parameters = {
+            "prompt": request.prompt,
+            "negative_prompt": request.negative_prompt,
+            "width": request.width,
+            "height": request.height,
+            "steps": request.steps,
+            "cfg_scale": request.cfg_scale,
+            "seed": seed
         }
+        # Sampler and model come from the batch that produced the image, not the (possibly switched) globals
+        info = dict(
+            parameters,
+            sampler=meta["sampler"],
+            model=meta["model"],
+            model_info=available_models.get(meta["model"], {})
+        )
+        
+        # A1111 clients expect info as a JSON string
+        return json_response({"images": [to_base64(image_bytes)], "parameters": parameters, "info": to_json(info)})
         
     except Exception as e:
         logger.error(f"Error generating image: {e}")
         # Fallback to enhanced placeholder
-        return generate_enhanced_placeholder(request)
+        return await asyncio.to_thread(generate_enhanced_placeholder, request)
+
+@app.post("/sdapi/v1/txt2img/raw")
+async def txt2img_raw(request: ImageRequest):
+    """Return the image bytes directly, skipping base64 and the JSON envelope"""
+    if pipeline is None:
+        raise HTTPException(status_code=503, detail="Stable Diffusion pipeline not loaded")
+    
+    try:
+        image_bytes, seed, _ = await generate_image(request)
+    except Exception as e:
+        logger.error(f"Error generating image: {e}")
+        raise HTTPException(status_code=500, detail="Failed to generate image")
+    
+    return Response(content=image_bytes, media_type=image_media_type(request.format), headers={"X-Seed": str(seed)})
+
+def wrap_text(text: str, font, max_width: int, max_lines: int = 4):
+    """Greedy word wrap measured in rendered pixels, stopping once max_lines are full"""
+    lines = []
+    line = ""
+    for word in text.split():
+        candidate = f"{line} {word}" if line else word
+        if line and font.getlength(candidate) > max_width:
+            lines.append(line)
+            if len(lines) == max_lines:
+                return lines
+            line = word
+        else:
+            line = candidate
+    
+    if line:
+        lines.append(line)
+    return lines
+
+def gradient_array(height: int, width: int, color1, color2):
+    """Build a vertical gradient as an (H, W, 3) uint8 array, on the GPU when one is available"""
+    # The placeholder is the error fallback, often reached after a CUDA failure (OOM, poisoned context) -
+    # any GPU error drops through to the CPU path instead of failing the fallback itself
+    if torch.cuda.is_available():
+        try:
+            t = (torch.arange(height, device="cuda", dtype=torch.float32) / height).unsqueeze(1)
+            c1 = torch.tensor(color1, device="cuda", dtype=torch.float32)
+            c2 = torch.tensor(color2, device="cuda", dtype=torch.float32)
+            rows = (c1 * (1 - t) + c2 * t).to(torch.uint8)
+            return rows.unsqueeze(1).expand(height, width, 3).contiguous().cpu().numpy()
+        except Exception as e:
+            logger.warning(f"⚠️ GPU gradient failed, using CPU: {e}")
+    
+    t = np.arange(height, dtype=np.float32)[:, None] / height
+    c1 = np.array(color1, dtype=np.float32)
+    c2 = np.array(color2, dtype=np.float32)
+    rows = (c1 * (1 - t) + c2 * t).astype(np.uint8)
+    return np.broadcast_to(rows[:, None, :], (height, width, 3)).copy()
 
 def generate_enhanced_placeholder(request: ImageRequest):
     """Generate an enhanced placeholder image when SD fails"""
     try:
         # Create a more artistic placeholder
-        from PIL import ImageDraw, ImageFont
         import random
         
         # Random colors based on prompt
-        seed = sum(ord(c) for c in request.prompt) % 1000
+        seed = int.from_bytes(hashlib.blake2b(request.prompt.encode(), digest_size=4).digest(), "little")
         random.seed(seed)
         
         color1 = (random.randint(100, 255), random.randint(100, 255), random.randint(100, 255))
         color2 = (random.randint(50, 200), random.randint(50, 200), random.randint(50, 200))
         
-        img = Image.new('RGB', (request.width, request.height))
-        draw = ImageDraw.Draw(img)
-        
         # Create gradient background
-        for y in range(request.height):
-            ratio = y / request.height
-            r = int(color1[0] * (1 - ratio) + color2[0] * ratio)
-            g = int(color1[1] * (1 - ratio) + color2[1] * ratio)
-            b = int(color1[2] * (1 - ratio) + color2[2] * ratio)
-            draw.line([(0, y), (request.width, y)], fill=(r, g, b))
+        img = Image.fromarray(gradient_array(request.height, request.width, color1, color2), 'RGB')
+        draw = ImageDraw.Draw(img)
         
         # Add text overlay
-        try:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 24)
-        except:
-            font = ImageFont.load_default()
-        
-        # Add prompt text
-        lines = []
-        words = request.prompt.split()
-        current_line = ""
-        for word in words:
-            if len(current_line + " " + word) < 35:
-                current_line += " " + word if current_line else word
-            else:
-                lines.append(current_line)
-                current_line = word
-        if current_line:
-            lines.append(current_line)
+        font = get_font(24)
         
+        # Add prompt text, wrapped to the image width (max 4 lines)
+        lines = wrap_text(request.prompt, font, request.width - 40, max_lines=4)
         y_start = request.height // 3
-        for i, line in enumerate(lines[:4]):  # Max 4 lines
-            draw.text((20, y_start + i * 30), line, fill="white", font=font, stroke_width=2, stroke_fill="black")
+        for y, line in zip(range(y_start, y_start + 4 * 30, 30), lines):
+            draw.text((20, y), line, fill="white", font=font, stroke_width=2, stroke_fill="black")
         
         # Add generation info
         draw.text((20, request.height - 60), f"AI-Style Placeholder • {request.width}x{request.height}", 
@@ -662,13 +1246,8 @@ def generate_enhanced_placeholder(request: ImageRequest):
         draw.text((20, request.height - 30), "Connect real SD model for actual AI generation", 
                  fill="white", font=font, stroke_width=1, stroke_fill="black")
         
-        # Convert to base64
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        img_b64 = base64.b64encode(buffer.getvalue()).decode()
-        
-        return {
-            "images": [img_b64],
+        return json_response({
+            "images": [to_base64(encode_image(img, request.format))],
             "parameters": {
                 "prompt": request.prompt,
                 "width": request.width,
@@ -676,12 +1255,12 @@ def generate_enhanced_placeholder(request: ImageRequest):
                 "steps": request.steps,
                 "cfg_scale": request.cfg_scale
             },
-            "info": json.dumps({
+            "info": to_json({
                 "prompt": request.prompt,
                 "model": "enhanced-placeholder",
                 "note": "Real SD model not available, using enhanced placeholder"
             })
-        }
+        })
         
     except Exception as e:
         logger.error(f"Failed to generate placeholder: {e}")
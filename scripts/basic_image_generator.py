@@ -8,57 +8,119 @@ import sys
 import json
 import struct
 import zlib
+import io
 import math
+import functools
 
-def create_png(width, height, pixels):
-    """Create a PNG file from RGB pixel data"""
-    def write_chunk(chunk_type, data):
-        chunk_crc = zlib.crc32(data, zlib.crc32(chunk_type.encode('ascii')))
-        return (struct.pack("!I", len(data)) +
-                chunk_type.encode('ascii') +
-                data +
-                struct.pack("!I", chunk_crc & 0xffffffff))
-
-    def write_png(width, height, pixels):
-        raw_data = b''.join(
-            b'\x00' + struct.pack("!%dI" % width, *row)
-            for row in pixels
-        )
-        
-        compressor = zlib.compressobj()
-        compressed = compressor.compress(raw_data)
-        compressed += compressor.flush()
-        
-        return (b'\x89PNG\r\n\x1a\n' +
-                write_chunk('IHDR', struct.pack("!2I5B", width, height, 8, 2, 0, 0, 0)) +
-                write_chunk('IDAT', compressed) +
-                write_chunk('IEND', b''))
+try:
+    import numpy as np  # Optional: vectorized gradient, falls back to pure Python
+except ImportError:
+    np = None
+
+try:
+    import numba  # Optional: compiled, multi-threaded gradient kernel on top of NumPy
+except ImportError:
+    numba = None
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def gradient_kernel(out, colors, phase, with_pattern):
+        """Fill an (H, W, 3) uint8 buffer with the gradient, one row per thread"""
+        height, width = out.shape[0], out.shape[1]
+        for y in numba.prange(height):
+            t_vertical = y / height
+            if t_vertical < 0.5:
+                row_ratio = t_vertical * 2
+                a, b = 0, 1
+            else:
+                row_ratio = (t_vertical - 0.5) * 2
+                a, b = 1, 2
+            
+            for x in range(width):
+                ratio = row_ratio + (x / width * 0.3 - 0.15)
+                ratio = min(max(ratio, 0.0), 1.0)
+                pattern = math.sin((x + y) * 0.1 + phase) * 20
+                for c in range(3):
+                    v = int(colors[a, c] * (1 - ratio) + colors[b, c] * ratio)
+                    if with_pattern:
+                        v = int(v + pattern)
+                        v = 0 if v < 0 else 255 if v > 255 else v
+                    out[y, x, c] = v
+
+# PNG chunk types, kept as bytes so chunk writing never re-encodes them
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+IHDR = b'IHDR'
+IDAT = b'IDAT'
+IEND = b'IEND'
+
+def png_chunk(chunk_type, data):
+    """Build a complete PNG chunk (length, type, data, CRC) for a small payload"""
+    # One exactly-sized buffer filled in place; the CRC covers type + data, read through a view
+    end = 8 + len(data)
+    buf = bytearray(end + 4)
+    struct.pack_into("!I4s", buf, 0, len(data), chunk_type)
+    buf[8:end] = data
+    struct.pack_into("!I", buf, end, zlib.crc32(memoryview(buf)[4:end]))
+    return bytes(buf)
+
+@functools.lru_cache(maxsize=32)
+def ihdr_chunk(width, height):
+    """IHDR chunk for an 8-bit RGB image, cached since the same few sizes are requested over and over"""
+    return png_chunk(IHDR, struct.pack("!2I5B", width, height, 8, 2, 0, 0, 0))
+
+IEND_CHUNK = png_chunk(IEND, b'')
+
+def write_png_to(file, width, height, pixels, compression=1):
+    """Stream an RGB PNG to a binary file one scanline at a time, returning the number of bytes written"""
+    def write_chunk(chunk_type, pieces):
+        length = sum(len(piece) for piece in pieces)
+        chunk_crc = zlib.crc32(chunk_type)
+        file.write(struct.pack("!I", length))
+        file.write(chunk_type)
+        for piece in pieces:
+            chunk_crc = zlib.crc32(piece, chunk_crc)
+            file.write(piece)
+        file.write(struct.pack("!I", chunk_crc))
+        return 12 + length
     
-    # Convert RGB tuples to 32-bit integers (RGB + alpha)
-    pixel_data = []
+    # Rows (array rows or packed RGB bytes) already are the RGB bytes PNG wants - each just gets a
+    # leading filter byte (0 = none). Only the compressed output is held, never a full raw copy.
+    # Level 1 is many times faster than the default 6 and smooth gradients compress well anyway
+    if np is not None and isinstance(pixels, np.ndarray):
+        pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    compressor = zlib.compressobj(compression)
+    compressed = []
     for row in pixels:
-        row_data = []
-        for r, g, b in row:
-            # Pack as 32-bit RGBA (alpha = 255)
-            pixel = (r << 24) | (g << 16) | (b << 8) | 0xFF
-            row_data.append(pixel)
-        pixel_data.append(row_data)
+        for piece in (b'\x00', row):
+            out = compressor.compress(piece)
+            if out:
+                compressed.append(out)
+    compressed.append(compressor.flush())
     
-    return write_png(width, height, pixel_data)
+    header = PNG_SIGNATURE + ihdr_chunk(width, height)
+    file.write(header)
+    size = len(header) + write_chunk(IDAT, compressed)
+    file.write(IEND_CHUNK)
+    return size + len(IEND_CHUNK)
+
+def create_png(width, height, pixels, compression=1):
+    """Create an RGB PNG file in memory from RGB pixel data (an (H, W, 3) array or rows of packed RGB bytes)"""
+    buffer = io.BytesIO()
+    write_png_to(buffer, width, height, pixels, compression)
+    return buffer.getvalue()
 
 def text_to_colors(prompt):
     """Generate colors based on text prompt using hash"""
+    # Hash the prompt once, then derive each color with a SplitMix64 step: a golden-ratio increment
+    # followed by multiply/xorshift rounds, so all 64 bits feed the 24 that are kept
+    mask = 0xFFFFFFFFFFFFFFFF
+    base = hash(prompt) & mask
     colors = []
-    for i, char in enumerate(prompt[:3]):
-        hash_val = hash(prompt + str(i))
-        r = (hash_val & 0xFF0000) >> 16
-        g = (hash_val & 0x00FF00) >> 8
-        b = hash_val & 0x0000FF
-        colors.append((r, g, b))
-    
-    # Ensure we have at least 3 colors
-    while len(colors) < 3:
-        hash_val = hash(prompt + str(len(colors)))
+    for i in range(3):
+        hash_val = (base + (i + 1) * 0x9E3779B97F4A7C15) & mask
+        hash_val = ((hash_val ^ (hash_val >> 30)) * 0xBF58476D1CE4E5B9) & mask
+        hash_val = ((hash_val ^ (hash_val >> 27)) * 0x94D049BB133111EB) & mask
+        hash_val ^= hash_val >> 31
         r = (hash_val & 0xFF0000) >> 16
         g = (hash_val & 0x00FF00) >> 8
         b = hash_val & 0x0000FF
@@ -67,43 +129,97 @@ def text_to_colors(prompt):
     return colors
 
 def generate_gradient(width, height, colors, prompt):
-    """Generate a gradient image with text elements"""
+    """Generate a gradient image as an (H, W, 3) uint8 array, or rows of packed RGB bytearrays without NumPy"""
+    if np is None:
+        return generate_gradient_pure(width, height, colors, prompt)
+    
+    if numba is not None:
+        pixels = np.empty((height, width, 3), dtype=np.uint8)
+        phase = hash(prompt) * 0.001 if prompt else 0.0
+        gradient_kernel(pixels, np.array(colors, dtype=np.float64), phase, len(prompt) > 0)
+        return pixels
+    
+    ys = np.arange(height)[:, None]
+    xs = np.arange(width)[None, :]
+    tv = ys / height
+    th = xs / width
+    
+    # Top half blends colors 0->1, bottom half 1->2, with some horizontal variation
+    top = tv < 0.5
+    ratio = np.where(top, tv * 2, (tv - 0.5) * 2) + (th * 0.3 - 0.15)
+    np.clip(ratio, 0, 1, out=ratio)
+    ratio = ratio[..., None]
+    
+    palette = np.array(colors, dtype=np.float64)
+    color_a = np.where(top[..., None], palette[0], palette[1])
+    color_b = np.where(top[..., None], palette[1], palette[2])
+    rgb = np.trunc(color_a * (1 - ratio) + color_b * ratio)
+    
+    # Add some pattern based on prompt
+    if len(prompt) > 0:
+        pattern = np.sin((xs + ys) * 0.1 + hash(prompt) * 0.001) * 20
+        rgb = np.trunc(rgb + pattern[..., None])
+    
+    return np.clip(rgb, 0, 255).astype(np.uint8)
+
+def generate_gradient_pure(width, height, colors, prompt):
+    """Generate a gradient image as rows of packed RGB bytearrays (3 bytes per pixel)"""
     pixels = []
     
+    # The pattern only depends on x + y, so there are just width + height distinct sines. They are
+    # floored to ints up front: once clamped, int(r + p) and r + floor(p) agree for any int r
+    if len(prompt) > 0:
+        phase = hash(prompt) * 0.001
+        sin_lut = [math.floor(math.sin(s * 0.1 + phase) * 20) for s in range(width + height)]
+    else:
+        sin_lut = None
+    
+    # Horizontal variation per column, shared by every row
+    h_offsets = [x / width * 0.3 - 0.15 for x in range(width)]
+    
     for y in range(height):
-        row = []
+        row = bytearray(3 * width)
+        
+        # Create gradient based on position - the vertical part is fixed for the whole row
+        t_vertical = y / height
+        
+        # Mix colors based on position
+        if t_vertical < 0.5:
+            # Top half: gradient between first two colors
+            row_ratio = t_vertical * 2
+            color_a, color_b = colors[0], colors[1]
+        else:
+            # Bottom half: gradient between second and third colors
+            row_ratio = (t_vertical - 0.5) * 2
+            color_a, color_b = colors[1], colors[2]
+        
+        ra, ga, ba = color_a
+        rb, gb, bb = color_b
+        
         for x in range(width):
-            # Create gradient based on position
-            t_vertical = y / height
-            t_horizontal = x / width
-            
-            # Mix colors based on position
-            if t_vertical < 0.5:
-                # Top half: gradient between first two colors
-                ratio = t_vertical * 2
-                color_a, color_b = colors[0], colors[1]
-            else:
-                # Bottom half: gradient between second and third colors
-                ratio = (t_vertical - 0.5) * 2
-                color_a, color_b = colors[1], colors[2]
-            
             # Add some horizontal variation
-            ratio += (t_horizontal * 0.3 - 0.15)
-            ratio = max(0, min(1, ratio))
+            ratio = row_ratio + h_offsets[x]
+            ratio = 0 if ratio < 0 else 1 if ratio > 1 else ratio
             
             # Linear interpolation between colors
-            r = int(color_a[0] * (1 - ratio) + color_b[0] * ratio)
-            g = int(color_a[1] * (1 - ratio) + color_b[1] * ratio)
-            b = int(color_a[2] * (1 - ratio) + color_b[2] * ratio)
+            r = int(ra * (1 - ratio) + rb * ratio)
+            g = int(ga * (1 - ratio) + gb * ratio)
+            b = int(ba * (1 - ratio) + bb * ratio)
             
             # Add some pattern based on prompt
-            if len(prompt) > 0:
-                pattern_val = math.sin((x + y) * 0.1 + hash(prompt) * 0.001) * 20
-                r = max(0, min(255, int(r + pattern_val)))
-                g = max(0, min(255, int(g + pattern_val)))
-                b = max(0, min(255, int(b + pattern_val)))
+            if sin_lut is not None:
+                pattern_val = sin_lut[x + y]
+                r += pattern_val
+                g += pattern_val
+                b += pattern_val
+                r = 0 if r < 0 else 255 if r > 255 else r
+                g = 0 if g < 0 else 255 if g > 255 else g
+                b = 0 if b < 0 else 255 if b > 255 else b
             
-            row.append((r, g, b))
+            i = 3 * x
+            row[i] = r
+            row[i + 1] = g
+            row[i + 2] = b
         
         pixels.append(row)
     
@@ -118,6 +234,23 @@ def add_text_pattern(pixels, width, height, prompt):
     start_y = height // 2 - 10
     start_x = max(0, (width - len(text) * 8) // 2)
     
+    if np is not None and isinstance(pixels, np.ndarray):
+        if start_y + 16 >= height:
+            return pixels
+        
+        # Every glyph is the same 6 columns of bits repeated over 8 rows, so build all columns at once
+        codes = np.array([ord(char) % 16 for char in text], dtype=np.int64)
+        char_x = start_x + 8 * np.arange(len(text))
+        px = np.arange(6)
+        lit = (((codes[:, None] >> (px % 4)) & 1) == 1) & (char_x[:, None] + 8 < width)
+        xs = (char_x[:, None] + px)[lit]
+        ys = start_y + np.arange(8)
+        ys = ys[(ys >= 0) & (ys < height)]
+        
+        # Make text white
+        pixels[ys[:, None], xs[None, :]] = 255
+        return pixels
+    
     for i, char in enumerate(text):
         char_x = start_x + i * 8
         if char_x + 8 < width and start_y + 16 < height:
@@ -130,7 +263,7 @@ def add_text_pattern(pixels, width, height, prompt):
                         x_pos = char_x + px
                         if 0 <= y_pos < height and 0 <= x_pos < width:
                             # Make text white
-                            pixels[y_pos][x_pos] = (255, 255, 255)
+                            pixels[y_pos][3 * x_pos:3 * x_pos + 3] = b'\xff\xff\xff'
     
     return pixels
 
@@ -161,6 +294,7 @@ def main():
     height = 512
     style = "natural"
     output_path = "generated_image.png"
+    compression = 1  # zlib level: 1 = fastest, 9 = smallest file
     
     # Parse additional JSON options if provided
     if len(sys.argv) > 2:
@@ -170,17 +304,17 @@ def main():
             height = options.get('height', height)
             style = options.get('style', style)
             output_path = options.get('output', output_path)
+            compression = options.get('compression', compression)
         except:
             pass
     
     # Generate image
     try:
         pixels = generate_image(prompt, width, height, style)
-        png_data = create_png(width, height, pixels)
         
-        # Write to file
+        # Stream to file
         with open(output_path, 'wb') as f:
-            f.write(png_data)
+            file_size = write_png_to(f, width, height, pixels, compression)
         
         # Output metadata
         result = {
@@ -190,7 +324,7 @@ def main():
             "width": width,
             "height": height,
             "style": style,
-            "file_size": len(png_data)
+            "file_size": file_size
         }
         
         print(json.dumps(result))
@@ -9,6 +9,7 @@ import sys
 import json
 import os
 import random
+import functools
 from PIL import Image, ImageDraw, ImageFont
 import colorsys
 
@@ -43,31 +44,41 @@ def generate_abstract_image(prompt, width=512, height=512, style="natural"):
     if style == "geometric":
         generate_geometric_pattern(draw, width, height, colors, prompt)
     elif style == "organic":
-        generate_organic_pattern(draw, width, height, colors, prompt)
+        generate_organic_pattern(image, width, height, colors, prompt)
     elif style == "artistic":
         generate_artistic_pattern(draw, width, height, colors, prompt)
     else:  # natural/default
-        generate_gradient_pattern(draw, width, height, colors, prompt)
+        generate_gradient_pattern(image, width, height, colors, prompt)
     
-    # Add text overlay
-    add_text_overlay(draw, prompt, width, height)
+    # Add text overlay - through an RGBA draw so the backdrop's alpha is blended in place
+    add_text_overlay(ImageDraw.Draw(image, 'RGBA'), prompt, width, height)
     
     return image
 
-def generate_gradient_pattern(draw, width, height, colors, prompt):
+def paste_vertical_gradient(image, width, height, row_colors):
+    """Fill the image with one color per row, stretching a single column instead of drawing a line per row"""
+    column = Image.new('RGB', (1, height))
+    column.putdata(row_colors)
+    image.paste(column.resize((width, height), Image.NEAREST))
+
+def generate_gradient_pattern(image, width, height, colors, prompt):
     """Generate a gradient background with shapes"""
     # Create gradient background
+    row_colors = []
     for y in range(height):
         ratio = y / height
         r = int(colors[0][0] * (1-ratio) + colors[1][0] * ratio)
         g = int(colors[0][1] * (1-ratio) + colors[1][1] * ratio)
         b = int(colors[0][2] * (1-ratio) + colors[1][2] * ratio)
-        draw.line([(0, y), (width, y)], fill=(r, g, b))
+        row_colors.append((r, g, b))
+    paste_vertical_gradient(image, width, height, row_colors)
     
     # Add some shapes based on prompt keywords
     hash_val = hash(prompt)
     random.seed(hash_val)
     
+    # An RGBA draw blends translucent fills straight into the RGB image, no overlay layers needed
+    overlay_draw = ImageDraw.Draw(image, 'RGBA')
     for _ in range(3):
         x = random.randint(0, width)
         y = random.randint(0, height)
@@ -75,16 +86,8 @@ def generate_gradient_pattern(draw, width, height, colors, prompt):
         color = colors[random.randint(0, len(colors)-1)]
         
         # Add some transparency
-        overlay = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-        overlay_draw = ImageDraw.Draw(overlay)
         overlay_draw.ellipse([x-size, y-size, x+size, y+size], 
                            fill=(*color, 100))  # Semi-transparent
-        
-        # Composite the overlay
-        image = Image.alpha_composite(
-            Image.new('RGBA', (width, height), (255, 255, 255, 255)),
-            overlay
-        )
 
 def generate_geometric_pattern(draw, width, height, colors, prompt):
     """Generate geometric patterns"""
@@ -108,9 +111,10 @@ def generate_geometric_pattern(draw, width, height, colors, prompt):
         elif shape_type == 'circle':
             draw.ellipse([x, y, x+size, y+size], fill=color)
 
-def generate_organic_pattern(draw, width, height, colors, prompt):
+def generate_organic_pattern(image, width, height, colors, prompt):
     """Generate organic, flowing patterns"""
     # Gradient background
+    row_colors = []
     for y in range(height):
         ratio = y / height
         color_index = int(ratio * (len(colors) - 1))
@@ -121,7 +125,8 @@ def generate_organic_pattern(draw, width, height, colors, prompt):
         g = int(colors[color_index][1] * (1-local_ratio) + colors[next_color_index][1] * local_ratio)
         b = int(colors[color_index][2] * (1-local_ratio) + colors[next_color_index][2] * local_ratio)
         
-        draw.line([(0, y), (width, y)], fill=(r, g, b))
+        row_colors.append((r, g, b))
+    paste_vertical_gradient(image, width, height, row_colors)
 
 def generate_artistic_pattern(draw, width, height, colors, prompt):
     """Generate artistic brush-like patterns"""
@@ -142,15 +147,20 @@ def generate_artistic_pattern(draw, width, height, colors, prompt):
         
         draw.line([x1, y1, x2, y2], fill=color, width=width_stroke)
 
+@functools.lru_cache(maxsize=16)
+def get_font(size):
+    """Load the overlay font once per size"""
+    try:
+        return ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", size)
+    except OSError:
+        return ImageFont.load_default()
+
 def add_text_overlay(draw, prompt, width, height):
     """Add text overlay to the image"""
     try:
         # Try to use a system font
         font_size = max(16, min(width, height) // 20)
-        try:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", font_size)
-        except:
-            font = ImageFont.load_default()
+        font = get_font(font_size)
         
         # Truncate long prompts
         display_text = prompt[:50] + "..." if len(prompt) > 50 else prompt